@@ -15,13 +15,28 @@ Think of it like a restaurant where:
 Let's build it step by step!
 """
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from openai import OpenAI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+import msgspec
+from openai import AsyncOpenAI, OpenAIError, RateLimitError
 from langfuse import Langfuse
 from dotenv import load_dotenv
+from cachetools import TTLCache
+from aiolimiter import AsyncLimiter
+import redis.asyncio as redis
+from contextlib import aclosing, asynccontextmanager
+import logging
+import logging.handlers
+import queue
+import asyncio
+import httpx
+from hashlib import sha256
+import orjson
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timezone
 import uuid
 
 # ============================================================================
@@ -31,39 +46,423 @@ import uuid
 # It's like having a helper read your recipe card before you start cooking
 
 load_dotenv()  # Loads variables from .env file into environment
-print("✓ Environment variables loaded from .env file")
+
+# Our log messages go into a queue, and a separate thread writes them out
+# (see setup_logging below). That way a request never has to wait for the
+# terminal to print something.
+# Set LOG_LEVEL=DEBUG to see every step of every request.
+logger = logging.getLogger("chatbot")
+log_listener = None
+
+def setup_logging():
+    """Starts the log-writing thread (only once per process)."""
+    global log_listener
+    
+    # Only set this up once, even if this file gets imported twice
+    # (otherwise every message would be printed twice)
+    if logger.handlers:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    log_listener.start()
+    
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(os.getenv("LOG_LEVEL", "WARNING").upper())
+    logger.propagate = False
 
 # ============================================================================
 # STEP 1: Initialize Our Tools
 # ============================================================================
-# Think of this as gathering all your ingredients before cooking
+# Think of this as gathering all your ingredients before cooking.
+#
+# The actual connections (OpenAI, Langfuse, Redis...) are made in
+# connect_tools() when the server starts, not when this file is imported.
+# With several workers this file gets imported more than once per process,
+# and we only want ONE set of connections in each.
 
-app = FastAPI(title="Traced Chatbot")
+# orjson turns our answers into JSON several times faster than Python's
+# built-in json module
+app = FastAPI(title="Traced Chatbot", default_response_class=ORJSONResponse)
 
-# Connect to OpenAI (the kitchen that makes answers)
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-print("✓ Connected to OpenAI")
+http_client = None     # Shared connection pool to OpenAI
+openai_client = None   # The kitchen that makes answers
+langfuse = None        # The manager taking notes
 
-# Connect to Langfuse (the manager taking notes)
-langfuse = Langfuse(
-    public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
-    secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
-    host=os.getenv("LANGFUSE_HOST", "http://localhost:3000")
-)
-print("✓ Connected to Langfuse")
+# Where the Langfuse dashboard lives (read once here, not on every request)
+LANGFUSE_HOST = os.getenv("LANGFUSE_HOST", "http://localhost:3000")
+TRACE_URL_PREFIX = f"{LANGFUSE_HOST}/trace/"
+TRACES_URL = f"{LANGFUSE_HOST}/traces"
+
+# Short-lived environments (like AWS Lambda) may be frozen right after the
+# response is sent, before the background batch goes out. Set
+# LANGFUSE_ENFORCE_FLUSH=true there to flush at the end of every request.
+LANGFUSE_ENFORCE_FLUSH = os.getenv("LANGFUSE_ENFORCE_FLUSH", "false").lower() == "true"
+
+# Log the (currently do-nothing) response processing step as its own span
+ENABLE_PROCESSING_SPAN = os.getenv("ENABLE_PROCESSING_SPAN", "false").lower() == "true"
+
+# Send the actual questions and answers to Langfuse, not just token counts.
+# Off by default: the text is usually most of the trace size (and may be
+# private). Model names and token usage are always sent.
+CAPTURE_CONTENT = os.getenv("LANGFUSE_CAPTURE_CONTENT", "false").lower() == "true"
+
+# Notes for Langfuse that are still being written down in the background.
+# We keep a reference to each task so Python doesn't throw it away early.
+background_tasks = set()
+
+def run_in_background(log_call, **kwargs):
+    """
+    Runs a Langfuse logging call after the current request has moved on.
+    
+    Like the manager writing up the order notes once the food is served,
+    instead of making the customer wait while they write.
+    """
+    
+    # When we flush at the end of every request, the notes must be
+    # written before that flush, so don't postpone them
+    if LANGFUSE_ENFORCE_FLUSH:
+        log_call(**kwargs)
+        return
+    
+    async def write_note():
+        log_call(**kwargs)
+    
+    task = asyncio.create_task(write_note())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# The order settings we send to the kitchen every time
+MODEL = "gpt-3.5-turbo"
+
+# The kitchen's standing instructions. They never change, so they always go
+# FIRST and the user's question (which changes every time) goes LAST - that's
+# the order OpenAI's prompt caching needs on models that support it.
+SYSTEM_PROMPT = "You are a helpful assistant that explains things simply."
+
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Everything that stays the same on every call, in the order OpenAI sees it.
+# Built once; each request only adds its own user message at the end.
+PROMPT_PREFIX = (SYSTEM_MESSAGE,)
+
+# A fingerprint of that fixed part, so cache keys don't re-hash the whole
+# prompt on every request
+PROMPT_PREFIX_HASH = sha256(orjson.dumps(PROMPT_PREFIX)).hexdigest()
+TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
+MAX_TOKENS = 500  # Maximum length of the answer
+
+# Remember answers we've already cooked, so repeat orders are served instantly.
+# Only used when TEMPERATURE is 0 - otherwise GPT is supposed to vary its
+# answers and handing out a stored one would change the behaviour.
+RESPONSE_CACHE_TTL = 3600  # Keep answers for 1 hour
+response_cache = TTLCache(maxsize=10_000, ttl=RESPONSE_CACHE_TTL)  # up to 10k answers
+
+# With several server workers, each one has its own response_cache above, so a
+# question answered by one worker is a miss on the others. Set REDIS_URL to
+# share one cache between all of them. If Redis can't be reached (or takes
+# too long to answer) we quietly fall back to the local cache.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT_SECONDS = 0.25  # A cache that makes us wait isn't worth waiting for
+redis_client = None  # Connected in connect_tools() if REDIS_URL is set
+REDIS_KEY_PREFIX = "chatbot:response:"
+REDIS_LOOKUPS_COUNTER = "chatbot:cache:lookups"  # hit rate = hits / lookups
+REDIS_HITS_COUNTER = "chatbot:cache:hits"
+
+# Fetch an answer and update both counters in a single trip to Redis.
+# A plain pipeline can't count the hit, because it doesn't know yet whether
+# the GET will find anything - this small script runs inside Redis and can.
+REDIS_LOOKUP_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+redis.call('INCR', KEYS[2])
+if cached then
+    redis.call('INCR', KEYS[3])
+end
+return cached
+"""
+redis_lookup = None
+
+# If Redis goes down, don't keep knocking on its door: skip it for a while
+# and use the local cache, instead of waiting (and warning) on every request
+REDIS_COOLDOWN_SECONDS = 30
+redis_retry_after = float("-inf")  # time.monotonic() when we try Redis again
+
+def redis_available():
+    """True if we have Redis and aren't waiting out a cooldown."""
+    return redis_client is not None and time.monotonic() >= redis_retry_after
+
+def redis_failed(error):
+    """Starts a cooldown after a Redis error (warning once per cooldown)."""
+    global redis_retry_after
+    
+    if time.monotonic() >= redis_retry_after:
+        logger.warning(
+            "Redis unavailable, using local cache for %ds: %s", REDIS_COOLDOWN_SECONDS, error
+        )
+    redis_retry_after = time.monotonic() + REDIS_COOLDOWN_SECONDS
+
+# Optionally also recognise questions that MEAN the same thing
+# ("What is France's capital?" vs "Capital of France?").
+# We turn each question into an embedding (a list of numbers describing its
+# meaning) and look for a close enough one we've already answered.
+# Like the exact cache, this only kicks in when TEMPERATURE is 0.
+# It needs one extra package: pip install -r requirements-semantic.txt
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = 0.92  # How similar two questions must be (0 to 1)
+SEMANTIC_CACHE_MAX_ENTRIES = 10_000
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+semantic_index = None  # Built in connect_tools() if SEMANTIC_CACHE_ENABLED
+semantic_answers = []  # Position in this list = label in the index
+
+# ============================================================================
+# Don't overwhelm the kitchen
+# ============================================================================
+# OpenAI only accepts so many requests (and tokens) per minute. If a burst of
+# users goes over that, OpenAI answers "429 Too Many Requests" and everyone
+# has to retry. Instead we pace ourselves:
+# - a semaphore caps how many calls are being started at once
+# - two limiters keep us under the requests-per-minute and tokens-per-minute
+#   budgets
+#
+# The settings below are for the WHOLE server (set them to your account's
+# limits). Every worker process gets its own limiters, so each one only uses
+# its share: the limit divided by the number of workers.
+
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "3500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "90000"))
+RATE_LIMIT_PAUSE_SECONDS = 15  # Back off this long after OpenAI says "slow down"
+
+# How many workers share those limits (uvicorn reads the same variable)
+SERVER_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+WORKER_MAX_CONCURRENCY = max(1, OPENAI_MAX_CONCURRENCY // SERVER_WORKERS)
+WORKER_RPM_LIMIT = max(1, OPENAI_RPM_LIMIT // SERVER_WORKERS)
+WORKER_TPM_LIMIT = max(1, OPENAI_TPM_LIMIT // SERVER_WORKERS)
+
+# Streamed answers keep a connection to OpenAI open until the last piece is
+# read, which can take a while with a slow reader. This caps how many can be
+# open at once (also for the whole server, shared out between workers).
+OPENAI_MAX_OPEN_STREAMS = int(os.getenv("OPENAI_MAX_OPEN_STREAMS", "256"))
+WORKER_MAX_OPEN_STREAMS = max(1, OPENAI_MAX_OPEN_STREAMS // SERVER_WORKERS)
+
+openai_semaphore = asyncio.Semaphore(WORKER_MAX_CONCURRENCY)
+request_limiter = AsyncLimiter(max_rate=WORKER_RPM_LIMIT, time_period=60)
+token_limiter = AsyncLimiter(max_rate=WORKER_TPM_LIMIT, time_period=60)
+open_streams = asyncio.Semaphore(WORKER_MAX_OPEN_STREAMS)
+
+# Rough size of the fixed part of every prompt (about 4 characters per token)
+PROMPT_PREFIX_TOKENS = sum(len(m["content"]) for m in PROMPT_PREFIX) // 4
+
+class OpenAIStatusTracker:
+    """Keeps count of what's happening with our OpenAI calls."""
+    
+    def __init__(self):
+        self.requests_in_progress = 0
+        self.requests_succeeded = 0
+        self.requests_failed = 0
+        self.rate_limit_errors = 0
+        self.time_last_rate_limit = float("-inf")  # time.monotonic() of the last 429 (none yet)
+    
+    def as_dict(self):
+        """The counters, ready to show in the logs or the /openai/status endpoint"""
+        return {
+            "requests_in_progress": self.requests_in_progress,
+            "requests_succeeded": self.requests_succeeded,
+            "requests_failed": self.requests_failed,
+            "rate_limit_errors": self.rate_limit_errors,
+            "seconds_since_last_rate_limit": (
+                round(time.monotonic() - self.time_last_rate_limit, 1)
+                if self.rate_limit_errors else None
+            )
+        }
+
+openai_status = OpenAIStatusTracker()
+
+def estimate_chat_tokens(message: str):
+    """Tokens a chat call may use: fixed prompt + the question + the longest answer"""
+    return PROMPT_PREFIX_TOKENS + len(message) // 4 + MAX_TOKENS
+
+@asynccontextmanager
+async def openai_request_slot(estimated_tokens: int):
+    """
+    Waits for our turn to call OpenAI, then keeps track of how it went.
+    
+    Like a kitchen that only takes a new order once a cook is free,
+    and takes a short break if the head chef says "too many orders!"
+    """
+    
+    async with openai_semaphore:
+        # If OpenAI recently told us to slow down, wait out the rest of the pause
+        since_rate_limit = time.monotonic() - openai_status.time_last_rate_limit
+        if since_rate_limit < RATE_LIMIT_PAUSE_SECONDS:
+            await asyncio.sleep(RATE_LIMIT_PAUSE_SECONDS - since_rate_limit)
+        
+        await request_limiter.acquire()
+        await token_limiter.acquire(min(estimated_tokens, WORKER_TPM_LIMIT))
+        
+        openai_status.requests_in_progress += 1
+        try:
+            yield
+        except RateLimitError:
+            openai_status.rate_limit_errors += 1
+            openai_status.time_last_rate_limit = time.monotonic()
+            openai_status.requests_failed += 1
+            logger.warning(
+                "OpenAI rate limit hit, pausing new calls for %ds (%s)",
+                RATE_LIMIT_PAUSE_SECONDS, openai_status.as_dict()
+            )
+            raise
+        except Exception:
+            openai_status.requests_failed += 1
+            raise
+        else:
+            openai_status.requests_succeeded += 1
+        finally:
+            openai_status.requests_in_progress -= 1
+
+@app.on_event("startup")
+async def connect_tools():
+    """Makes all the connections, once per server worker."""
+    global http_client, openai_client, langfuse, redis_client, redis_lookup, semantic_index
+    
+    setup_logging()
+    logger.info("✓ Environment variables loaded from .env file")
+    
+    # One shared connection pool to OpenAI, reused by every request.
+    # Keeping connections open saves a new TCP/TLS handshake per call, and the
+    # higher limits let many orders go to the kitchen at the same time.
+    # (With HTTP/2 many calls share one connection, so this is not what limits
+    # how many calls or streams are open - the semaphores further up do that.)
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0)
+    )
+    
+    # Connect to OpenAI (the kitchen that makes answers)
+    # We use the async client so that while one order is cooking, the waiter
+    # can go take other orders instead of standing at the kitchen door
+    openai_client = AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=http_client
+    )
+    logger.info("✓ Connected to OpenAI")
+    
+    # Connect to Langfuse (the manager taking notes)
+    langfuse = Langfuse(
+        public_key=os.getenv("LANGFUSE_PUBLIC_KEY"),
+        secret_key=os.getenv("LANGFUSE_SECRET_KEY"),
+        host=LANGFUSE_HOST,
+        # Langfuse collects events in the background and sends them in batches:
+        # every 50 events or every second, whichever comes first
+        flush_at=50,
+        flush_interval=1.0
+    )
+    logger.info("✓ Connected to Langfuse")
+    
+    if REDIS_URL:
+        redis_client = redis.Redis.from_url(
+            REDIS_URL,
+            decode_responses=False,
+            socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+            socket_timeout=REDIS_TIMEOUT_SECONDS
+        )
+        redis_lookup = redis_client.register_script(REDIS_LOOKUP_SCRIPT)
+    
+    if SEMANTIC_CACHE_ENABLED:
+        import hnswlib
+        
+        semantic_index = hnswlib.Index(space="cosine", dim=1536)  # text-embedding-3-small size
+        semantic_index.init_index(max_elements=SEMANTIC_CACHE_MAX_ENTRIES)
+
+@app.on_event("shutdown")
+async def flush_langfuse():
+    """Send any notes still waiting in the batch before the server stops."""
+    # Let the background notes finish first so they are part of the flush
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    langfuse.flush()
+
+@app.on_event("shutdown")
+async def stop_log_listener():
+    """Write out any log messages still in the queue."""
+    if log_listener is not None:
+        log_listener.stop()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """Close the pooled connections to OpenAI (and Redis)."""
+    if http_client is not None:
+        await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 # ============================================================================
 # STEP 2: Define What Data Looks Like
 # ============================================================================
 # These are like order forms - they specify what information we need
 
-class ChatRequest(BaseModel):
-    """What the user sends us"""
+class ChatRequest(msgspec.Struct):
+    """
+    What the user sends us.
+    
+    A msgspec Struct rather than a Pydantic model: msgspec reads it
+    straight from the raw JSON bytes, several times faster.
+    """
     message: str           # The question they're asking
     user_id: str = "anonymous"  # Who's asking (optional)
 
+# Reused for every request, so the order form is only "learned" once
+chat_request_decoder = msgspec.json.Decoder(ChatRequest)
+
+class ChatRequestSchema(BaseModel):
+    """
+    Same as ChatRequest, used to describe it in the API docs (/docs) and
+    to explain what's wrong with a request msgspec turned down.
+    """
+    message: str
+    user_id: str = "anonymous"
+
+# Tells the API docs what the /chat endpoints expect, since they read the
+# request body themselves
+CHAT_REQUEST_OPENAPI = {
+    "requestBody": {
+        "content": {"application/json": {"schema": ChatRequestSchema.model_json_schema()}},
+        "required": True
+    }
+}
+
+async def read_chat_request(http_request: Request):
+    """Reads and checks the JSON the user sent."""
+    body = await http_request.body()
+    try:
+        return chat_request_decoder.decode(body)
+    except (msgspec.DecodeError, msgspec.ValidationError):
+        pass
+    
+    # Only badly filled-in order forms get here. Let Pydantic check the body
+    # again, so the user gets FastAPI's usual 422 error list
+    # ({"detail": [{"loc": [...], "msg": ..., "type": ...}]}).
+    try:
+        checked = ChatRequestSchema.model_validate_json(body)
+    except ValidationError as error:
+        raise RequestValidationError([
+            {**detail, "loc": ("body", *detail["loc"])}
+            for detail in error.errors(include_url=False)
+        ])
+    
+    # Pydantic was happy with something msgspec wasn't - go with Pydantic
+    return ChatRequest(message=checked.message, user_id=checked.user_id)
+
 class ChatResponse(BaseModel):
-    """What we send back to the user"""
+    """
+    What we send back to the user.
+    
+    Only used to describe the answer in the API docs (/docs). /chat builds
+    a plain dict with these fields, so we don't pay for re-checking data
+    we just put together ourselves.
+    """
     response: str          # The answer from GPT
     trace_id: str          # A unique ID to find this conversation later
     trace_url: str         # A link to see details in Langfuse
@@ -75,8 +474,12 @@ class ChatResponse(BaseModel):
 # ============================================================================
 # This is where the magic happens!
 
-@app.post("/chat")
-def chat(request: ChatRequest):
+@app.post(
+    "/chat",
+    responses={200: {"model": ChatResponse}},
+    openapi_extra=CHAT_REQUEST_OPENAPI
+)
+async def chat(http_request: Request):
     """
     The main function that handles a chat request.
     
@@ -87,71 +490,167 @@ def chat(request: ChatRequest):
     4. Tells manager what happened (logs to Langfuse)
     """
     
-    # Generate a unique ID for this conversation
-    # Like giving each restaurant order a ticket number
-    trace_id = str(uuid.uuid4())
+    request = await read_chat_request(http_request)
     
     # Start logging this conversation to Langfuse
-    # The "trace" is like the order ticket - it tracks the whole conversation
-    trace = langfuse.trace(
-        id=trace_id,
-        name="chat_conversation",
-        user_id=request.user_id,
-        input={"message": request.message},
-        metadata={
-            "timestamp": datetime.now().isoformat(),
-            "message_length": len(request.message)
-        },
-        tags=["chatbot", "gpt-3.5"]
-    )
+    trace_id, trace = start_trace(request)
     
-    print(f"📝 Started tracking conversation: {trace_id}")
-    
-    # Call OpenAI to get the answer
-    # This is like sending the order to the kitchen
-    llm_response = call_openai(
-        message=request.message,
-        trace=trace
-    )
-    
-    # Process the response (in this simple version, we just pass it through)
-    # In a real app, you might check for bad words, format it nicely, etc.
-    final_response = process_response(
-        llm_response=llm_response,
-        trace=trace
-    )
-    
-    # Update the trace with the final result
-    # Like the manager noting "Order completed successfully!"
-    trace.update(
-        output={
+    output = {}
+    try:
+        # Call OpenAI to get the answer
+        # This is like sending the order to the kitchen
+        llm_response = await call_openai(
+            message=request.message,
+            trace=trace
+        )
+        
+        # Process the response (in this simple version, we just pass it through)
+        # In a real app, you might check for bad words, format it nicely, etc.
+        final_response = process_response(
+            llm_response=llm_response,
+            trace=trace
+        )
+        output = {
             "response": final_response["text"],
             "tokens": final_response["tokens"]
         }
-    )
+    except BaseException as error:
+        # Failed (or cancelled) conversations show up in Langfuse too
+        output = {"error": str(error) or type(error).__name__}
+        raise
+    finally:
+        # Send the trace with the final result - exactly once, whatever happened
+        # Like the manager noting "Order completed successfully!"
+        finish_trace(trace, output=output)
+        
+        # Langfuse sends the data in the background, so we don't wait for it here.
+        # Only force it out now if we might not get another chance
+        # (failed requests too - those are the traces we want most).
+        if LANGFUSE_ENFORCE_FLUSH:
+            langfuse.flush()
     
-    # Send the data to Langfuse immediately (don't wait)
-    langfuse.flush()
-    
-    print(f"✅ Conversation completed: {trace_id}")
+    logger.debug("✅ Conversation completed: %s", trace_id)
     
     # Build the URL where the user can see details
-    trace_url = f"{os.getenv('LANGFUSE_HOST', 'http://localhost:3000')}/trace/{trace_id}"
+    trace_url = TRACE_URL_PREFIX + trace_id
     
     # Return the answer to the user
-    return ChatResponse(
-        response=final_response["text"],
-        trace_id=trace_id,
-        trace_url=trace_url,
-        tokens_used=final_response["tokens"],
-        model=final_response["model"]
+    # (same fields as ChatResponse)
+    return {
+        "response": final_response["text"],
+        "trace_id": trace_id,
+        "trace_url": trace_url,
+        "tokens_used": final_response["tokens"],
+        "model": final_response["model"]
+    }
+
+@app.post("/chat/stream", openapi_extra=CHAT_REQUEST_OPENAPI)
+async def chat_stream(http_request: Request):
+    """
+    Same as /chat, but sends the answer piece by piece as GPT writes it.
+    
+    Like a kitchen sending out each course as soon as it's ready,
+    instead of making you wait until the whole meal is done.
+    The answer arrives as Server-Sent Events; the trace ID and URL
+    are in the X-Trace-Id and X-Trace-Url response headers.
+    """
+    
+    request = await read_chat_request(http_request)
+    trace_id, trace = start_trace(request)
+    trace_url = TRACE_URL_PREFIX + trace_id
+    
+    async def event_stream():
+        # stream_openai fills this in as the answer arrives
+        result = {"text": "", "tokens": 0}
+        error = None
+        try:
+            # Each piece of text is sent as one "data:" event (JSON-encoded so
+            # line breaks inside the answer don't break the event format).
+            # aclosing() makes sure stream_openai finishes its own clean-up
+            # before ours below, even if the user disconnects.
+            async with aclosing(stream_openai(request.message, trace, result)) as pieces:
+                async for piece in pieces:
+                    yield b"data: " + orjson.dumps(piece) + b"\n\n"
+            yield b"data: [DONE]\n\n"
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            # The one place the streamed trace is sent - exactly once,
+            # whether it finished, failed, or the user went away
+            output = {"response": result["text"], "tokens": result["tokens"]}
+            if error is not None:
+                output["error"] = str(error) or type(error).__name__
+            finish_trace(trace, output=output)
+            
+            if LANGFUSE_ENFORCE_FLUSH:
+                langfuse.flush()
+        
+        logger.debug("✅ Conversation completed: %s", trace_id)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"X-Trace-Id": trace_id, "X-Trace-Url": trace_url}
     )
 
+def start_trace(request: ChatRequest):
+    """
+    Starts a new conversation record.
+    
+    Returns the trace ID and the trace itself. The trace is just a dict
+    for now - nothing is sent to Langfuse until finish_trace(), so the
+    whole trace (input AND output) goes out as one event instead of a
+    "create" followed by an "update".
+    """
+    
+    # Generate a unique ID for this conversation
+    # Like giving each restaurant order a ticket number
+    trace_id = uuid.uuid4().hex
+    
+    # The "trace" is like the order ticket - it tracks the whole conversation
+    trace = {
+        "id": trace_id,
+        "name": "chat_conversation",
+        "user_id": request.user_id,
+        "input": {"message": request.message} if CAPTURE_CONTENT else None,
+        "metadata": {
+            "timestamp": time.time_ns(),  # Nanoseconds since 1970, cheap to get
+            "message_length": len(request.message)
+        },
+        "tags": ["chatbot", "gpt-3.5"]
+    }
+    
+    logger.debug("📝 Started tracking conversation: %s", trace_id)
+    
+    return trace_id, trace
+
+def finish_trace(trace: dict, output: dict):
+    """
+    Sends the whole trace to Langfuse in one go, now that we know the output.
+    
+    Generations and spans are sent separately and linked to it by trace ID.
+    The answer text is left out unless CAPTURE_CONTENT is on.
+    """
+    
+    if not CAPTURE_CONTENT:
+        output = {key: value for key, value in output.items() if key != "response"}
+    
+    def send_trace():
+        langfuse.trace(
+            **trace,
+            output=output,
+            # When the conversation started, not when we sent the trace
+            timestamp=datetime.fromtimestamp(trace["metadata"]["timestamp"] / 1e9, tz=timezone.utc)
+        )
+    
+    run_in_background(send_trace)
+
 # ============================================================================
 # STEP 4: Call OpenAI (The Kitchen)
 # ============================================================================
 
-def call_openai(message: str, trace):
+async def call_openai(message: str, trace):
     """
     Sends the question to OpenAI and gets an answer.
     
@@ -162,25 +661,30 @@ def call_openai(message: str, trace):
     It automatically tracks tokens, costs, and model info!
     """
     
-    print(f"  🤖 Asking GPT-3.5: {message[:50]}...")
+    # Serve it from a cache if we can
+    cached, cache_key, embedding = await check_caches(message, trace)
+    if cached is not None:
+        return cached
+    
+    logger.debug("  🤖 Asking GPT-3.5: %s...", message[:50])
     
     # Actually call OpenAI's API
     # This is where the magic happens - GPT generates the answer
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system", 
-                "content": "You are a helpful assistant that explains things simply."
-            },
-            {
-                "role": "user", 
-                "content": message
-            }
-        ],
-        temperature=0.7,
-        max_tokens=500  # Maximum length of the answer
-    )
+    # "await" lets the server handle other requests while we wait for GPT
+    async with openai_request_slot(estimate_chat_tokens(message)):
+        start_time = datetime.now()
+        response = await openai_client.chat.completions.create(
+            model=MODEL,
+            messages=build_messages(message),
+            temperature=TEMPERATURE,
+            max_tokens=MAX_TOKENS
+        )
+        end_time = datetime.now()
+    
+    # How many prompt tokens OpenAI served from its own prompt cache
+    # (older API versions don't report this, so we fall back to 0)
+    prompt_details = getattr(response.usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(prompt_details, "cached_tokens", None) or 0
     
     # Extract what we need from OpenAI's response
     result = {
@@ -191,23 +695,273 @@ def call_openai(message: str, trace):
     
     # Log this as a GENERATION (not a regular span)
     # This tells Langfuse "this is an LLM call, track tokens and cost!"
-    trace.generation(
+    run_in_background(
+        langfuse.generation,
+        trace_id=trace["id"],
         name="openai_api_call",
         model=response.model,  # e.g., "gpt-3.5-turbo-0125"
-        input=message,
-        output=result["text"],
+        input=message if CAPTURE_CONTENT else None,
+        output=result["text"] if CAPTURE_CONTENT else None,
+        start_time=start_time,  # The notes are sent later, so pass the real times
+        end_time=end_time,
         usage={
             "promptTokens": response.usage.prompt_tokens,      # Tokens in your question
             "completionTokens": response.usage.completion_tokens,  # Tokens in GPT's answer
             "totalTokens": response.usage.total_tokens        # Total (input + output)
         },
         metadata={
-            "temperature": 0.7,
-            "max_tokens": 500
+            "temperature": TEMPERATURE,
+            "max_tokens": MAX_TOKENS,
+            "cache_hit": False,
+            "cached_prompt_tokens": cached_tokens  # Tokens reused from OpenAI's prompt cache
         }
     )
     
-    print(f"  ✓ Got answer ({result['tokens']} tokens)")
+    await remember_answer(cache_key, embedding, result)
+    
+    logger.debug("  ✓ Got answer (%d tokens)", result["tokens"])
+    
+    return result
+
+def build_messages(message: str):
+    """
+    Puts together the full conversation we send to GPT.
+    
+    The fixed part goes first, so OpenAI can reuse its prompt cache;
+    the user's question (the only part that changes) always goes last.
+    """
+    return [*PROMPT_PREFIX, {"role": "user", "content": message}]
+
+async def stream_openai(message: str, trace, result: dict):
+    """
+    Like call_openai, but hands back the answer piece by piece.
+    
+    The generation is still logged with the full text and token usage,
+    once GPT has finished (or the user has gone away). The final text and
+    token count are also written into `result`, for the caller's trace.
+    """
+    
+    # A cached answer is sent in one go
+    cached, cache_key, embedding = await check_caches(message, trace)
+    if cached is not None:
+        result.update(cached)
+        yield cached["text"]
+        return
+    
+    logger.debug("  🤖 Asking GPT-3.5 (streaming): %s...", message[:50])
+    
+    # Hold one of this worker's stream places for as long as the answer is
+    # flowing, so slow readers can't pile up an unlimited number of streams
+    async with open_streams:
+        # Only hold a slot while the stream is being started. Once OpenAI is
+        # sending pieces, a slow reader on the other end shouldn't block
+        # everyone else's calls (the stream place above still caps them).
+        async with openai_request_slot(estimate_chat_tokens(message)):
+            start_time = datetime.now()
+            stream = await openai_client.chat.completions.create(
+                model=MODEL,
+                messages=build_messages(message),
+                temperature=TEMPERATURE,
+                max_tokens=MAX_TOKENS,
+                stream=True,
+                stream_options={"include_usage": True}  # Send token counts in the last chunk
+            )
+        
+        pieces = []
+        model = MODEL
+        usage = None  # Only arrives at the very end of the stream
+        first_token_time = None
+        
+        try:
+            async for chunk in stream:
+                model = chunk.model
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token_time is None:
+                        first_token_time = datetime.now()
+                    pieces.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Runs even if the user disconnects halfway through,
+            # so Langfuse always sees what was generated
+            result.update(
+                text="".join(pieces),
+                tokens=usage.total_tokens if usage else 0,
+                model=model
+            )
+        
+            prompt_details = getattr(usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(prompt_details, "cached_tokens", None) or 0
+        
+            run_in_background(
+                langfuse.generation,
+                trace_id=trace["id"],
+                name="openai_api_call",
+                model=model,
+                input=message if CAPTURE_CONTENT else None,
+                output=result["text"] if CAPTURE_CONTENT else None,
+                start_time=start_time,
+                completion_start_time=first_token_time,  # Time to first token
+                end_time=datetime.now(),
+                usage={
+                    "promptTokens": usage.prompt_tokens if usage else 0,
+                    "completionTokens": usage.completion_tokens if usage else 0,
+                    "totalTokens": result["tokens"]
+                },
+                metadata={
+                    "temperature": TEMPERATURE,
+                    "max_tokens": MAX_TOKENS,
+                    "cache_hit": False,
+                    "cached_prompt_tokens": cached_tokens,
+                    "stream": True
+                }
+            )
+        
+            # Only cache answers that finished (usage comes with the last chunk)
+            if usage is not None:
+                await remember_answer(cache_key, embedding, dict(result))
+        
+            logger.debug("  ✓ Streamed answer (%d tokens)", result["tokens"])
+
+async def check_caches(message: str, trace):
+    """
+    Looks for a stored answer to this question.
+    
+    Returns (cached_result, cache_key, embedding). cached_result is None on
+    a miss; cache_key and embedding are needed to store the new answer.
+    """
+    
+    cache_key = None
+    embedding = None
+    
+    # Check if we've answered this exact question before
+    # Like the kitchen keeping a tray of dishes that were just made
+    if TEMPERATURE == 0:
+        cache_key = sha256(orjson.dumps({
+            "model": MODEL,
+            "prompt_prefix": PROMPT_PREFIX_HASH,
+            "message": message,
+            "temperature": TEMPERATURE,
+            "max_tokens": MAX_TOKENS
+        }, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        
+        cached = await get_cached_response(cache_key)
+        if cached is not None:
+            logger.debug("  ⚡ Cache hit, skipping GPT-3.5: %s...", message[:50])
+            
+            return log_cache_hit(trace, message, cached, cache_type="exact"), cache_key, embedding
+    
+    # Check if we've answered a question that means the same thing.
+    # Same rule as above: with TEMPERATURE above 0, GPT is supposed to vary
+    # its answers, so we don't hand out stored ones at all.
+    if SEMANTIC_CACHE_ENABLED and TEMPERATURE == 0:
+        lookup_start = datetime.now()
+        try:
+            # Embeddings count against the same OpenAI request budget
+            async with openai_request_slot(len(message) // 4):
+                embedding_response = await openai_client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=message
+                )
+        except OpenAIError as error:
+            # The cache is optional - if it can't be checked, just ask GPT
+            logger.warning("Semantic cache lookup failed, treating as a miss: %s", error)
+            return None, cache_key, embedding
+        embedding = embedding_response.data[0].embedding
+        
+        similarity = 0.0
+        if semantic_index.get_current_count() > 0:
+            labels, distances = semantic_index.knn_query([embedding], k=1)
+            similarity = 1 - float(distances[0][0])  # cosine distance -> similarity
+        
+        semantic_hit = similarity > SEMANTIC_CACHE_THRESHOLD
+        # Sent as one finished span, instead of a "start" and an "end" event
+        run_in_background(
+            langfuse.span,
+            trace_id=trace["id"],
+            name="semantic_cache_lookup",
+            input=message if CAPTURE_CONTENT else None,
+            start_time=lookup_start,
+            end_time=datetime.now(),
+            metadata={"similarity": similarity, "hit": semantic_hit}
+        )
+        
+        if semantic_hit:
+            logger.debug("  ⚡ Semantic cache hit (%.2f), skipping GPT-3.5: %s...", similarity, message[:50])
+            cached = semantic_answers[int(labels[0][0])]
+            return log_cache_hit(trace, message, cached, cache_type="semantic"), cache_key, embedding
+    
+    return None, cache_key, embedding
+
+async def get_cached_response(cache_key: str):
+    """Looks up an exact-match answer, in Redis if we have it."""
+    
+    if redis_available():
+        try:
+            # One round trip: fetch the answer and count the lookup (and hit)
+            cached = await redis_lookup(
+                keys=[REDIS_KEY_PREFIX + cache_key, REDIS_LOOKUPS_COUNTER, REDIS_HITS_COUNTER]
+            )
+            return orjson.loads(cached) if cached is not None else None
+        except redis.RedisError as error:
+            redis_failed(error)
+    
+    return response_cache.get(cache_key)
+
+async def remember_answer(cache_key, embedding, result: dict):
+    """Stores a fresh answer in whichever caches are turned on."""
+    
+    if cache_key is not None:
+        stored_in_redis = False
+        if redis_available():
+            try:
+                await redis_client.set(
+                    REDIS_KEY_PREFIX + cache_key,
+                    orjson.dumps(result),
+                    ex=RESPONSE_CACHE_TTL
+                )
+                stored_in_redis = True
+            except redis.RedisError as error:
+                redis_failed(error)
+        
+        if not stored_in_redis:
+            response_cache[cache_key] = result
+    
+    if embedding is not None and len(semantic_answers) < SEMANTIC_CACHE_MAX_ENTRIES:
+        semantic_index.add_items([embedding], [len(semantic_answers)])
+        semantic_answers.append(result)
+
+def log_cache_hit(trace, message: str, cached: dict, cache_type: str):
+    """
+    Logs an answer that came from a cache instead of from OpenAI.
+    
+    We still record a generation so the trace shows where the answer
+    came from - just with zero tokens, since GPT didn't do any work.
+    """
+    
+    # No tokens were spent this time
+    result = {**cached, "tokens": 0}
+    
+    run_in_background(
+        langfuse.generation,
+        trace_id=trace["id"],
+        name="openai_api_call",
+        model=result["model"],
+        input=message if CAPTURE_CONTENT else None,
+        output=result["text"] if CAPTURE_CONTENT else None,
+        usage={
+            "promptTokens": 0,
+            "completionTokens": 0,
+            "totalTokens": 0
+        },
+        metadata={
+            "temperature": TEMPERATURE,
+            "max_tokens": MAX_TOKENS,
+            "cache_hit": True,
+            "cache_type": cache_type
+        }
+    )
     
     return result
 
@@ -226,33 +980,39 @@ def process_response(llm_response: dict, trace):
     - Format it nicely
     - Translate to another language
     
-    We still create a span to track this step, even though it's simple.
+    Since nothing happens here yet, a span for this step would only add
+    noise (and payload) to every trace. Set ENABLE_PROCESSING_SPAN=true
+    to log it anyway, e.g. once you add real processing.
     """
     
-    # Create another span for this processing step
-    span = trace.span(
-        name="response_processing",
-        input=llm_response,
-        metadata={"step": "validation"}
-    )
-    
-    print(f"  🔍 Processing response...")
-    
     # In this simple example, we don't modify anything
     # Just pass it through as-is
+    if not ENABLE_PROCESSING_SPAN:
+        return llm_response
+    
+    start_time = datetime.now()
+    
+    logger.debug("  🔍 Processing response...")
+    
     processed = {
         "text": llm_response["text"],
         "tokens": llm_response["tokens"],
         "model": llm_response["model"]
     }
     
-    # Mark this step as complete
-    span.end(
-        output=processed,
-        metadata={"status": "passed"}
+    # Log this processing step as one finished span
+    run_in_background(
+        langfuse.span,
+        trace_id=trace["id"],
+        name="response_processing",
+        input=llm_response if CAPTURE_CONTENT else None,
+        output=processed if CAPTURE_CONTENT else None,
+        start_time=start_time,
+        end_time=datetime.now(),
+        metadata={"step": "validation", "status": "passed"}
     )
     
-    print(f"  ✓ Processing complete")
+    logger.debug("  ✓ Processing complete")
     
     return processed
 
@@ -260,35 +1020,51 @@ def process_response(llm_response: dict, trace):
 # STEP 6: Health Check and Info Endpoints
 # ============================================================================
 # These are utility endpoints to check if everything is working
+# Their answers never change, so we build them once when the app starts
+# and hand out the same ready-made response every time.
+
+HEALTH_RESPONSE = ORJSONResponse({
+    "status": "healthy",
+    "message": "Chatbot is running!"
+})
+
+ROOT_RESPONSE = ORJSONResponse({
+    "message": "Welcome to the Traced Chatbot!",
+    "usage": {
+        "endpoint": "POST /chat",
+        "streaming_endpoint": "POST /chat/stream",
+        "openai_status": "GET /openai/status",
+        "example": {
+            "message": "What is observability?",
+            "user_id": "demo_user"
+        }
+    },
+    "view_traces": TRACES_URL
+})
 
 @app.get("/health")
-def health():
+async def health():
     """
     Simple endpoint to check if the service is alive.
     Like asking "Is anyone home?"
     """
-    return {
-        "status": "healthy",
-        "message": "Chatbot is running!"
-    }
+    return HEALTH_RESPONSE
+
+@app.get("/openai/status")
+async def openai_calls_status():
+    """
+    How this worker's calls to OpenAI are going (counts since it started).
+    Like asking the kitchen "how many orders are cooking, and any complaints?"
+    """
+    return openai_status.as_dict()
 
 @app.get("/")
-def root():
+async def root():
     """
     Root endpoint that shows usage instructions.
     Like the front door with a sign explaining what's inside.
     """
-    return {
-        "message": "Welcome to the Traced Chatbot!",
-        "usage": {
-            "endpoint": "POST /chat",
-            "example": {
-                "message": "What is observability?",
-                "user_id": "demo_user"
-            }
-        },
-        "view_traces": f"{os.getenv('LANGFUSE_HOST', 'http://localhost:3000')}/traces"
-    }
+    return ROOT_RESPONSE
 
 # ============================================================================
 # STEP 7: Start the Server
@@ -320,17 +1096,39 @@ if __name__ == "__main__":
         print("  export LANGFUSE_SECRET_KEY='sk-lf-your-key'")
         exit(1)
     
+    # One server process (worker) per CPU core, unless WEB_CONCURRENCY says otherwise
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    
+    # Each worker re-imports this file, and splits the OpenAI limits by this count
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    
     print("\n✅ All environment variables set!")
-    print(f"\n📊 View traces at: {os.getenv('LANGFUSE_HOST', 'http://localhost:3000')}/traces")
-    print(f"\n🌐 Starting server on http://localhost:8000")
+    print(f"\n📊 View traces at: {TRACES_URL}")
+    print(f"\n🌐 Starting server on http://localhost:8000 ({workers} workers)")
     print("\n📝 Test with:")
     print('   curl -X POST http://localhost:8000/chat \\')
     print('     -H "Content-Type: application/json" \\')
     print('     -d \'{"message":"What is AI?","user_id":"test"}\'')
+    print("\n   (use /chat/stream and curl -N to watch the answer arrive piece by piece)")
     print("\n" + "="*60 + "\n")
     
     # Start the web server
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # - Several workers share the load across CPU cores. Each worker imports
+    #   this file on its own, so we pass the app as "module:app" text
+    #   instead of the app object itself. With a single worker we hand over
+    #   the app we already have, so this file isn't imported a second time.
+    # - uvloop and httptools are faster, C-based versions of the event loop
+    #   and the HTTP parser (installed with uvicorn[standard])
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    uvicorn.run(
+        app if workers == 1 else f"{module_name}:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )
 
 # ============================================================================
 # HOW IT ALL WORKS TOGETHER (The Big Picture)
@@ -342,8 +1140,9 @@ When a user sends a message, here's what happens:
    User → POST /chat with their question
    
 2. CREATE TRACE
-   We generate a unique ID and start logging to Langfuse
+   We generate a unique ID and start filling in the trace
    Think: "Start a new order ticket #12345"
+   (it's only a note in memory until step 5)
    
 3. CALL OPENAI (Span #1)
    - Log: "Started asking GPT"
@@ -351,14 +1150,15 @@ When a user sends a message, here's what happens:
    - Get back the answer
    - Log: "Got answer, used X tokens"
    
-4. PROCESS RESPONSE (Span #2)
+4. PROCESS RESPONSE (Span #2, only if ENABLE_PROCESSING_SPAN=true)
    - Log: "Started processing"
    - Check/clean the response (in this simple version, do nothing)
    - Log: "Processing complete"
    
 5. FINISH TRACE
-   - Update the main trace with the final result
-   - Send everything to Langfuse
+   - Send the whole trace (question + final result) to Langfuse at once
+   - The Langfuse notes are written in a background task, after the
+     answer is on its way, and sent in batches
    
 6. RETURN TO USER
    - Send back the answer
@@ -367,11 +1167,17 @@ When a user sends a message, here's what happens:
 The result? You can now see:
 - How long each step took
 - How many tokens were used
-- What the input and output were
+- What the input and output were (with LANGFUSE_CAPTURE_CONTENT=true)
 - If any errors occurred
 - Who asked the question and when
 
 All without cluttering your code with tons of logging statements!
+
+STREAMING (POST /chat/stream)
+   Same steps, but the answer is sent to the user as GPT writes it.
+   The user sees the first words almost immediately, and the generation
+   is logged once the stream ends - with the full text, token usage,
+   and the time it took for the first word to appear.
 """
 
 # ============================================================================
@@ -439,6 +1245,41 @@ Example:
 - Which model we used (gpt-3.5-turbo)
 - What temperature setting (0.7)
 - How long the message was
+- Whether the answer came from the cache
+- How many prompt tokens OpenAI reused from its prompt cache
+
+
+🎯 RESPONSE CACHE
+-----------------
+If the exact same question comes in again (and TEMPERATURE is 0, so GPT
+would give the same answer anyway), we hand back the stored answer
+instead of calling OpenAI. It's faster and costs zero tokens.
+The generation is still logged, with cache_hit=True and zero usage.
+
+When the server runs several workers, set REDIS_URL so they all share
+one cache in Redis - otherwise each worker only remembers the answers
+it cooked itself.
+
+With SEMANTIC_CACHE_ENABLED=true (and TEMPERATURE still 0) we go one
+step further: questions that are worded differently but mean the same
+thing ("What is France's capital?" vs "Capital of France?") also get the
+stored answer. We compare
+embeddings, which cost far less than a chat completion, and the
+"semantic_cache_lookup" span shows how similar the closest match was.
+
+
+🎯 PROMPT CACHING (on OpenAI's side)
+------------------------------------
+On newer models (GPT-4o, GPT-4o mini, o1), OpenAI automatically remembers
+the beginning of prompts that are at least 1024 tokens long. If the next
+prompt starts with exactly the same text, those tokens are cheaper and the
+answer starts sooner. gpt-3.5-turbo doesn't do this, and our prompt is far
+shorter than 1024 tokens, so we don't pad it just to qualify.
+
+We still keep the fixed part first and the user's question at the very
+end, so a longer prompt or a newer model gets the benefit for free.
+The "cached_prompt_tokens" metadata on each generation shows how much
+of the prompt was reused (0 for now).
 
 
 🎯 TOKENS
@@ -460,6 +1301,10 @@ Telling Langfuse "send the data NOW, don't wait!"
 By default, Langfuse batches data and sends it every few seconds.
 Calling flush() says "I want to see it immediately!"
 
+Flushing waits on a network call, so we don't do it on every request.
+Instead we let the background batcher do its job and flush once when
+the server shuts down (or per request if LANGFUSE_ENFORCE_FLUSH=true).
+
 
 🎯 THE RESTAURANT ANALOGY
 -------------------------